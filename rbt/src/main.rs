@@ -1,7 +1,7 @@
 use anyhow::{Context, Result};
 use clap::Parser;
 use std::path::{Path, PathBuf};
-use std::process::Command;
+use std::process::{Command, Output};
 use tempfile::TempDir;
 use which::which;
 
@@ -53,14 +53,43 @@ struct Args {
     tape_size: usize
 }
 
+/// Toolchain binaries, looked up once before anything is built so a
+/// missing tool is reported up front
+struct Tools {
+    rasm: PathBuf,
+    rlink: PathBuf,
+    /// Only needed for macro output
+    bfm: Option<PathBuf>,
+    /// Only needed with --run
+    bf: Option<PathBuf>,
+}
+
+impl Tools {
+    fn resolve(args: &Args) -> Result<Self> {
+        let macro_output = args.format == "macro";
+        Ok(Self {
+            rasm: Self::find("rasm")?,
+            rlink: Self::find("rlink")?,
+            bfm: if macro_output { Some(Self::find("bfm")?) } else { None },
+            bf: if args.run { Some(Self::find("bf")?) } else { None },
+        })
+    }
+
+    fn find(name: &str) -> Result<PathBuf> {
+        which(name).with_context(|| format!("Could not find '{}' in PATH", name))
+    }
+}
+
 struct BuildContext {
     args: Args,
+    tools: Tools,
     temp_dir: Option<TempDir>,
     object_files: Vec<PathBuf>,
 }
 
 impl BuildContext {
     fn new(args: Args) -> Result<Self> {
+        let tools = Tools::resolve(&args)?;
         let temp_dir = if args.keep_temp {
             None
         } else {
@@ -69,6 +98,7 @@ impl BuildContext {
 
         Ok(Self {
             args,
+            tools,
             temp_dir,
             object_files: Vec::new(),
         })
@@ -82,10 +112,6 @@ impl BuildContext {
         }
     }
 
-    fn check_tool(name: &str) -> Result<PathBuf> {
-        which(name).with_context(|| format!("Could not find '{}' in PATH", name))
-    }
-
     fn run_command(&self, cmd: &mut Command) -> Result<()> {
         if self.args.verbose {
             eprintln!("Running: {:?}", cmd);
@@ -106,8 +132,6 @@ impl BuildContext {
     }
 
     fn assemble(&mut self, source: &Path) -> Result<PathBuf> {
-        let rasm = Self::check_tool("rasm")?;
-        
         let stem = source
             .file_stem()
             .context("Invalid source filename")?
@@ -115,7 +139,7 @@ impl BuildContext {
         
         let output = self.get_temp_path(&format!("{}.pobj", stem));
         
-        let mut cmd = Command::new(rasm);
+        let mut cmd = Command::new(&self.tools.rasm);
         cmd.arg("assemble")
             .arg("-b")
             .arg(self.args.bank_size.to_string())
@@ -130,15 +154,13 @@ impl BuildContext {
     }
 
     fn link(&self) -> Result<PathBuf> {
-        let rlink = Self::check_tool("rlink")?;
-        
         let output = if self.args.format == "macro" {
             self.get_temp_path("linked.bfm")
         } else {
             self.get_temp_path("linked.bin")
         };
 
-        let mut cmd = Command::new(rlink);
+        let mut cmd = Command::new(&self.tools.rlink);
         
         for obj in &self.object_files {
             cmd.arg(obj);
@@ -164,7 +186,7 @@ impl BuildContext {
     }
 
     fn expand(&self, macro_file: &Path) -> Result<PathBuf> {
-        let bfm = Self::check_tool("bfm")?;
+        let bfm = self.tools.bfm.as_ref().expect("bfm is resolved for macro output");
         
         let output = if let Some(ref user_output) = self.args.output {
             user_output.clone()
@@ -189,55 +211,64 @@ impl BuildContext {
         Ok(output)
     }
 
-    fn expand_to_stdout(&self, macro_file: &Path) -> Result<String> {
-        let bfm = Self::check_tool("bfm")?;
-        
-        let mut cmd = Command::new(bfm);
-        cmd.arg("expand")
-            .arg(macro_file);
+    fn expand_and_run(&self, macro_file: &Path) -> Result<()> {
+        let bfm = self.tools.bfm.as_ref().expect("bfm is resolved for macro output");
+        let bf = self.tools.bf.as_ref().expect("bf is resolved for --run");
 
-        if self.args.verbose {
-            eprintln!("Running: {:?}", cmd);
-        }
+        use std::process::Stdio;
 
-        let output = cmd.output()?;
+        // Stream the expanded program straight into the interpreter instead
+        // of buffering it; expanded programs can be many megabytes
+        let mut expand_cmd = Command::new(bfm);
+        expand_cmd.arg("expand")
+            .arg(macro_file)
+            .stdout(Stdio::piped())
+            .stderr(Stdio::piped());
 
-        if !output.status.success() {
-            let stderr = String::from_utf8_lossy(&output.stderr);
-            anyhow::bail!("Command failed: {}", stderr);
+        if self.args.verbose {
+            eprintln!("Running: {:?}", expand_cmd);
         }
 
-        Ok(String::from_utf8_lossy(&output.stdout).to_string())
-    }
+        let mut expander = expand_cmd.spawn()?;
+        let program = expander
+            .stdout
+            .take()
+            .context("Failed to capture expanded program")?;
 
-    fn run_bf_from_stdin(&self, bf_code: &str) -> Result<()> {
-        let bf = Self::check_tool("bf")?;
-        
         if self.args.verbose {
             eprintln!("Piping expanded code to bf interpreter");
         }
 
-        use std::io::Write;
-        use std::process::Stdio;
-        
-        let mut cmd = Command::new(bf)
+        let mut interpreter = Command::new(bf)
             .arg("--tape-size")
             .arg(self.args.tape_size.to_string())
             .arg("--cell-size")
             .arg("16")
-            .stdin(Stdio::piped())
+            .stdin(Stdio::from(program))
             .stdout(Stdio::inherit())
             .stderr(Stdio::inherit())
             .spawn()?;
 
-        if let Some(mut stdin) = cmd.stdin.take() {
-            stdin.write_all(bf_code.as_bytes())?;
-            stdin.flush()?;
-            drop(stdin); // Explicitly close stdin
+        // Drains bfm's stderr while bf consumes its stdout
+        let expanded = expander.wait_with_output()?;
+
+        if !expanded.status.success() {
+            if is_broken_pipe(&expanded) {
+                // bf stopped reading early, so its own failure is the real one
+                if !interpreter.wait()?.success() {
+                    anyhow::bail!("Brainfuck execution failed");
+                }
+            } else {
+                // bf only got part of the program, which could print garbage
+                // or never finish; don't wait for it
+                let _ = interpreter.kill();
+                let _ = interpreter.wait();
+            }
+            let stderr = String::from_utf8_lossy(&expanded.stderr);
+            anyhow::bail!("Failed to expand macros: {}", stderr);
         }
 
-        let status = cmd.wait()?;
-        
+        let status = interpreter.wait()?;
         if !status.success() {
             anyhow::bail!("Brainfuck execution failed");
         }
@@ -267,13 +298,12 @@ impl BuildContext {
                 eprintln!("Expanding macros...");
             }
             
-            // If we're running the program, expand to stdout and pipe directly
+            // If we're running the program, pipe the expansion directly into bf
             if self.args.run {
-                let bf_code = self.expand_to_stdout(&linked)?;
                 if self.args.verbose {
                     eprintln!("\nExecuting compiled program:");
                 }
-                self.run_bf_from_stdin(&bf_code)?;
+                self.expand_and_run(&linked)?;
                 Ok(None) // No output file when running directly
             } else {
                 // Otherwise, expand to file
@@ -299,6 +329,20 @@ impl BuildContext {
     }
 }
 
+/// Whether a failed child was writing into a pipe whose reader had gone:
+/// it either died of SIGPIPE or reported the EPIPE error
+fn is_broken_pipe(output: &Output) -> bool {
+    #[cfg(unix)]
+    {
+        use std::os::unix::process::ExitStatusExt;
+        const SIGPIPE: i32 = 13;
+        if output.status.signal() == Some(SIGPIPE) {
+            return true;
+        }
+    }
+    String::from_utf8_lossy(&output.stderr).contains("Broken pipe")
+}
+
 fn main() -> Result<()> {
     let args = Args::parse();
     
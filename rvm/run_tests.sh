@@ -10,18 +10,228 @@ NC='\033[0m' # No Color
 SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
 RASM="../src/ripple-asm/target/release/rasm"
 RLINK="../src/ripple-asm/target/release/rlink"
-VM="cargo run --release --"
+CACHE_DIR="tests/.cache"
+TIMES_FILE="tests/.times"
 
 # Configuration
 BANK_SIZE=4096
 
+# Toolchain flags shared by every test, built once
+RASM_FLAGS=(--bank-size "$BANK_SIZE")
+RLINK_FLAGS=(-f binary --bank-size "$BANK_SIZE")
+
+# Time limits in seconds. Assembling and linking can be slow on a cold
+# cache but never loop forever, so they get a generous limit; the VM run
+# is the step that can, so keep it tight
+BUILD_TIMEOUT=30
+RUN_TIMEOUT=5
+
+# Stop at the first failure (on by default in CI)
+FAIL_FAST=0
+if [ -n "$CI" ]; then
+    FAIL_FAST=1
+fi
+
+# Tests are independent, so run several at once; leave a couple of cores
+# free for the assembler/linker/VM processes each test spawns
+CPUS=$(getconf _NPROCESSORS_ONLN 2>/dev/null || echo 1)
+JOBS=$(( CPUS > 3 ? CPUS - 2 : 1 ))
+
+# Options
+LIST=0
+USE_CACHE=1
+SHARD=
+SELECTED=()
+
+usage() {
+    echo "Usage: $0 [options] [TEST...]"
+    echo
+    echo "Runs the named tests (e.g. test_hello), or all of them."
+    echo
+    echo "  -j, --jobs N    Run up to N tests at once (default: $JOBS)"
+    echo "  --fail-fast     Stop after the first failure (default in CI)"
+    echo "  --no-fail-fast  Run every test even after a failure"
+    echo "  --no-cache      Rebuild and rerun every test instead of reusing"
+    echo "                  up-to-date images in tests/bin and outputs"
+    echo "                  recorded in $CACHE_DIR (fresh outputs are still"
+    echo "                  recorded, so the cache ends up refreshed)"
+    echo "  --shard I/N     Run only the I-th of N slices of the tests, to spread"
+    echo "                  a run over N independent machines (e.g. --shard 2/4)"
+    echo "  --list          Print the test names and exit. Pass several names"
+    echo "                  to one invocation rather than one per test, so the"
+    echo "                  VM build check and job pool are shared, e.g."
+    echo "                  $0 \$($0 --list | grep mem)"
+    echo
+    echo "Intermediate files go to a temporary directory under /dev/shm when"
+    echo "available, else \$TMPDIR; set RVM_TEST_TMPDIR to choose another."
+}
+
+while [ $# -gt 0 ]; do
+    case $1 in
+        --fail-fast) FAIL_FAST=1 ;;
+        --no-fail-fast) FAIL_FAST=0 ;;
+        --list) LIST=1 ;;
+        --no-cache) USE_CACHE=0 ;;
+        --shard|-j|--jobs)
+            # A missing value must not fall back to a default: without
+            # the shard, every CI machine would run the whole suite
+            if [ $# -lt 2 ] || [ -z "$2" ]; then
+                echo "Option $1 needs a value" >&2
+                usage >&2
+                exit 2
+            fi
+            case $1 in
+                --shard) SHARD=$2 ;;
+                *) JOBS=$2 ;;
+            esac
+            shift
+            ;;
+        -h|--help)
+            usage
+            exit 0
+            ;;
+        -*)
+            echo "Unknown option: $1" >&2
+            usage >&2
+            exit 2
+            ;;
+        *) SELECTED+=("$1") ;;
+    esac
+    shift
+done
+
+case $JOBS in
+    ''|*[!0-9]*|0)
+        echo "Invalid job count: $JOBS" >&2
+        exit 2
+        ;;
+esac
+
+# Tests to run: the ones named on the command line, or every test found
+# with a single directory read (every match is a file, so there is no
+# need to stat each one again)
+if [ ${#SELECTED[@]} -gt 0 ]; then
+    tests=()
+    for test_name in "${SELECTED[@]}"; do
+        if [ ! -f "tests/asm/${test_name}.asm" ]; then
+            echo "Unknown test: $test_name" >&2
+            exit 2
+        fi
+        # A repeated name would only redo the same work (and share the
+        # same scratch directory), so run each test once
+        case " ${tests[*]} " in
+            *" $test_name "*) continue ;;
+        esac
+        tests+=("$test_name")
+    done
+else
+    shopt -s nullglob
+    tests=(tests/asm/*.asm)
+    shopt -u nullglob
+    tests=("${tests[@]##*/}")
+    tests=("${tests[@]%.asm}")
+fi
+
+# Keep every N-th test, starting at the I-th. Tests are in name order
+# here, so each shard gets the same slice on every machine.
+if [ -n "$SHARD" ]; then
+    SHARD_INDEX=${SHARD%%/*}
+    SHARD_COUNT=${SHARD#*/}
+    case $SHARD in
+        */*) ;;
+        *) SHARD_COUNT= ;;
+    esac
+    case $SHARD_INDEX in
+        ''|*[!0-9]*) SHARD_INDEX=0 ;;
+    esac
+    case $SHARD_COUNT in
+        ''|*[!0-9]*) SHARD_COUNT=0 ;;
+    esac
+    if [ $SHARD_INDEX -lt 1 ] || [ $SHARD_INDEX -gt $SHARD_COUNT ]; then
+        echo "Invalid shard: $SHARD (expected I/N with 1 <= I <= N)" >&2
+        exit 2
+    fi
+    SHARD_INDEX=$((10#$SHARD_INDEX))
+    SHARD_COUNT=$((10#$SHARD_COUNT))
+    sharded=()
+    for i in "${!tests[@]}"; do
+        if [ $((i % SHARD_COUNT)) -eq $((SHARD_INDEX - 1)) ]; then
+            sharded+=("${tests[$i]}")
+        fi
+    done
+    tests=("${sharded[@]}")
+fi
+
+if [ $LIST -eq 1 ]; then
+    if [ ${#tests[@]} -gt 0 ]; then
+        printf '%s\n' "${tests[@]}"
+    fi
+    exit 0
+fi
+
+# sha256 of stdin (coreutils on Linux, shasum on macOS)
+if command -v sha256sum > /dev/null; then
+    hash_stdin() { sha256sum | cut -d' ' -f1; }
+else
+    hash_stdin() { shasum -a 256 | cut -d' ' -f1; }
+fi
+
+# Wall clock in milliseconds, in NOW_MS (whole seconds before bash 5)
+now_ms() {
+    if [ -n "$EPOCHREALTIME" ]; then
+        local usec=${EPOCHREALTIME/[.,]/}
+        NOW_MS=$((10#$usec / 1000))
+    else
+        NOW_MS=$((SECONDS * 1000))
+    fi
+}
+
+# Succeeds if file $1 exists and is newer than every file after it
+newer_than_all() {
+    local target=$1 input
+    shift
+    [ -f "$target" ] || return 1
+    for input in "$@"; do
+        [ "$target" -nt "$input" ] || return 1
+    done
+}
+
+# Read output from stdin as it arrives until it ends, differs from the file
+# $1 or runs past its end. cmp and head -c wait for a whole block, so they
+# would miss a wrong line followed by silence. Byte-exact checking is still
+# left to cmp.
+watch_output() {
+    local LC_ALL=C got want
+    while IFS= read -r -n 1 got; do
+        IFS= read -r -n 1 want <&3 && [ "$got" = "$want" ] || return 1
+    done 3< "$1"
+}
+
 # Counters
 TOTAL=0
 PASSED=0
 FAILED=0
+ABORTED=0
+
+# Per-test scratch directories, so parallel tests don't clobber each other.
+# Intermediates are written once and read straight back, so keep them in
+# memory (tmpfs) where the platform has one. RVM_TEST_TMPDIR overrides.
+if [ -n "$RVM_TEST_TMPDIR" ]; then
+    SCRATCH_ROOT=$RVM_TEST_TMPDIR
+    mkdir -p "$SCRATCH_ROOT" || exit 1
+elif [ -d /dev/shm ] && [ -w /dev/shm ]; then
+    SCRATCH_ROOT=/dev/shm
+else
+    SCRATCH_ROOT=${TMPDIR:-/tmp}
+fi
+WORK_DIR=$(mktemp -d "$SCRATCH_ROOT/rvm-tests.XXXXXX") || exit 1
+trap 'rm -rf "$WORK_DIR"' EXIT
 
 echo "Running Ripple VM Tests"
 echo "======================"
+if [ -n "$SHARD" ]; then
+    echo "Shard $SHARD_INDEX of $SHARD_COUNT: ${#tests[@]} tests"
+fi
 echo
 
 # Build the VM first
@@ -29,78 +239,292 @@ echo "Building VM..."
 cargo build --release --quiet || exit 1
 echo
 
+# Run the built binary directly; `cargo run` would redo its freshness
+# check (and its own process startup) for every single test
+TARGET_DIR=$(cargo metadata --format-version 1 --no-deps 2>/dev/null | sed -n 's/.*"target_directory":"\([^"]*\)".*/\1/p')
+VM="${TARGET_DIR:-target}/release/rvm"
+
+# Check the toolchain once before starting; a missing assembler or linker
+# would otherwise show up as every single test failing
+for tool in "$RASM" "$RLINK" "$VM"; do
+    if [ ! -x "$tool" ]; then
+        echo -e "${RED}Missing $tool${NC}" >&2
+        if [ "$tool" = "$VM" ]; then
+            echo "cargo build succeeded but the VM is not where it was expected; check the" >&2
+            echo "target directory reported by 'cargo metadata' (it falls back to ./target)" >&2
+        else
+            echo "Build the assembler and linker with 'cargo build --release' in ../src/ripple-asm" >&2
+        fi
+        exit 1
+    fi
+done
+
+# Cached outputs are only valid for the toolchain (and flags) that produced
+# them, so they are kept in a directory named after both. Entries made with
+# any other toolchain can never be hit again, so they are removed; otherwise
+# every VM rebuild would leave a full set behind.
+TOOLCHAIN_HASH=$({ cat "$RASM" "$RLINK" "$VM"; echo "${RASM_FLAGS[*]} ${RLINK_FLAGS[*]}"; } 2>/dev/null | hash_stdin)
+TOOLCHAIN_CACHE="$CACHE_DIR/$TOOLCHAIN_HASH"
+mkdir -p "$TOOLCHAIN_CACHE"
+shopt -s nullglob
+for entry in "$CACHE_DIR"/*; do
+    if [ "$entry" != "$TOOLCHAIN_CACHE" ]; then
+        rm -rf "$entry"
+    fi
+done
+shopt -u nullglob
+
 # Function to run a single test
+# Runs in the background, so it reports through its exit status instead of
+# the counters: 0 = passed, 1 = failed, 2 = skipped
 run_test() {
     local test_name=$1
+    local work_dir="$WORK_DIR/$test_name"
     local asm_file="tests/asm/${test_name}.asm"
     local bin_file="tests/bin/${test_name}.bin"
     local expected_file="tests/expected/${test_name}.txt"
-    local output_file="tests/${test_name}.out"
-    
-    TOTAL=$((TOTAL + 1))
-    
-    # Check if test files exist
-    if [ ! -f "$asm_file" ]; then
-        echo -e "${RED}✗ $test_name: Assembly file not found${NC}"
-        FAILED=$((FAILED + 1))
-        return
-    fi
+    local pobj_file="$work_dir/${test_name}.pobj"
+    local output_file="$work_dir/${test_name}.out"
     
+    # Check if the expected output exists
     if [ ! -f "$expected_file" ]; then
         echo -e "${YELLOW}⚠ $test_name: Expected output file not found, skipping${NC}"
-        return
-    fi
-    
-    # Assemble
-    $RASM assemble "$asm_file" -o "tests/${test_name}.pobj" --bank-size $BANK_SIZE > /dev/null 2>&1
-    if [ $? -ne 0 ]; then
-        echo -e "${RED}✗ $test_name: Assembly failed${NC}"
-        FAILED=$((FAILED + 1))
-        return
-    fi
-    
-    # Link
-    $RLINK "tests/${test_name}.pobj" -o "$bin_file" -f binary --bank-size $BANK_SIZE > /dev/null 2>&1
-    if [ $? -ne 0 ]; then
-        echo -e "${RED}✗ $test_name: Linking failed${NC}"
-        FAILED=$((FAILED + 1))
-        rm -f "tests/${test_name}.pobj"
-        return
+        return 2
     fi
     
-    # Run VM
-    timeout 5 $VM "$bin_file" > "$output_file" 2>/dev/null
-    if [ $? -eq 124 ]; then
-        echo -e "${RED}✗ $test_name: Timeout${NC}"
-        FAILED=$((FAILED + 1))
-        rm -f "tests/${test_name}.pobj" "$output_file"
-        return
+    # Reuse the recorded output if neither the test nor the toolchain changed
+    local key=$(hash_stdin < "$asm_file")
+    local cached_file="$TOOLCHAIN_CACHE/$key.out"
+    if [ $USE_CACHE -eq 1 ] && [ -f "$cached_file" ]; then
+        cp "$cached_file" "$output_file"
+    else
+        RAN_TOOLS=1
+        
+        # Assemble and link, unless the linked image is newer than its
+        # source, the assembler, the linker and this script (which holds
+        # their flags). Saves both steps when only the VM has changed.
+        if [ $USE_CACHE -eq 0 ] || ! newer_than_all "$bin_file" "$asm_file" "$RASM" "$RLINK" "${BASH_SOURCE[0]}"; then
+            timeout "$BUILD_TIMEOUT" "$RASM" assemble "$asm_file" -o "$pobj_file" "${RASM_FLAGS[@]}" > /dev/null 2>&1
+            if [ $? -ne 0 ]; then
+                echo -e "${RED}✗ $test_name: Assembly failed${NC}"
+                return 1
+            fi
+            
+            # Link into the scratch directory first, so a failed link never
+            # leaves a fresh-looking image behind
+            timeout "$BUILD_TIMEOUT" "$RLINK" "$pobj_file" -o "$work_dir/${test_name}.bin" "${RLINK_FLAGS[@]}" > /dev/null 2>&1
+            if [ $? -ne 0 ]; then
+                echo -e "${RED}✗ $test_name: Linking failed${NC}"
+                return 1
+            fi
+            mv "$work_dir/${test_name}.bin" "$bin_file"
+        fi
+        
+        # Run VM (with its own disk image; the default one is shared),
+        # watching its output as it comes. Once a byte differs, or the VM
+        # has printed one byte past the expected output, the test can only
+        # fail, so the VM is killed there instead of running until the
+        # timeout. Closing the pipe alone would not stop it: rvm, like any
+        # Rust program, ignores SIGPIPE. tee stops at its next write after
+        # that, so the copy it keeps for the report stays small.
+        local vm_out="$work_dir/vm.out"
+        mkfifo "$vm_out"
+        timeout "$RUN_TIMEOUT" "$VM" --disk "$work_dir/disk.img" "$bin_file" > "$vm_out" 2>/dev/null &
+        local vm_pid=$!
+        # `timeout` passes the kill on to the VM
+        tee "$output_file" < "$vm_out" \
+            | { watch_output "$expected_file"; kill "$vm_pid" 2>/dev/null; }
+        wait "$vm_pid"
+        if [ $? -eq 124 ]; then
+            echo -e "${RED}✗ $test_name: Timeout${NC}"
+            return 1
+        fi
+        
+        # Only passing outputs are complete, so only those are cached. Copy
+        # then rename, so a concurrent reader never sees a partial entry.
+        if cmp -s "$expected_file" "$output_file"; then
+            cp "$output_file" "$cached_file.$test_name.tmp" && mv "$cached_file.$test_name.tmp" "$cached_file"
+        fi
     fi
     
-    # Compare output
-    if diff -q "$expected_file" "$output_file" > /dev/null; then
+    # Compare output (the scratch directory is removed on exit, so there
+    # is nothing to clean up here)
+    if cmp -s "$expected_file" "$output_file"; then
         echo -e "${GREEN}✓ $test_name${NC}"
-        PASSED=$((PASSED + 1))
-    else
-        echo -e "${RED}✗ $test_name: Output mismatch${NC}"
-        echo "  Expected:"
-        cat "$expected_file" | sed 's/^/    /'
-        echo "  Got:"
-        cat "$output_file" | sed 's/^/    /'
-        FAILED=$((FAILED + 1))
+        return 0
     fi
     
-    # Clean up
-    rm -f "tests/${test_name}.pobj" "$output_file"
+    echo -e "${RED}✗ $test_name: Output mismatch${NC}"
+    echo "  Expected:"
+    awk '{ print "    " $0 }' "$expected_file"
+    echo "  Got:"
+    head -c $(( $(wc -c < "$expected_file") + 1 )) "$output_file" | awk '{ print "    " $0 }'
+    return 1
 }
 
-# Run all tests
-for asm_file in tests/asm/*.asm; do
-    if [ -f "$asm_file" ]; then
-        test_name=$(basename "$asm_file" .asm)
-        run_test "$test_name"
+# run_test, recording how long it took in $WORK_DIR/times. Only runs that
+# actually built or ran the test count: a cache hit or a skip says nothing
+# about how long the test takes, so the previous time is kept instead.
+timed_test() {
+    local test_name=$1
+    RAN_TOOLS=0
+    now_ms
+    local start=$NOW_MS
+    run_test "$test_name"
+    local status=$?
+    now_ms
+    if [ $RAN_TOOLS -eq 1 ]; then
+        echo "$test_name $((NOW_MS - start))" >> "$WORK_DIR/times"
     fi
+    return $status
+}
+
+# Jobs in submission order: test name, pid, and exit status once finished.
+# Slots are refilled as soon as any job ends, while reports are printed in
+# submission order, so output stays stable without a slow job holding up
+# the pool.
+job_names=()
+job_pids=()
+job_status=()
+# Indices of the jobs still running, and of the next job to report
+running=()
+next_report=0
+
+# wait -n (bash 4.3+) wakes up as soon as any job ends; older bash polls
+if [ ${BASH_VERSINFO[0]} -gt 4 ] || { [ ${BASH_VERSINFO[0]} -eq 4 ] && [ ${BASH_VERSINFO[1]} -ge 3 ]; }; then
+    HAVE_WAIT_N=1
+else
+    HAVE_WAIT_N=0
+fi
+
+# Stop every job in flight along with the processes it started. Killing
+# just the job's subshell would orphan its rasm/rlink/VM; `timeout`
+# passes the signal on to the command it guards. Children are looked up
+# before the subshell dies, as they get reparented afterwards.
+stop_jobs() {
+    local i pid children
+    for i in "${running[@]}"; do
+        pid=${job_pids[$i]}
+        children=$(pgrep -P "$pid")
+        kill "$pid" 2> /dev/null
+        if [ -n "$children" ]; then
+            kill $children 2> /dev/null
+        fi
+    done
+    wait 2> /dev/null
+    running=()
+}
+
+# Background jobs ignore SIGINT, so on Ctrl-C they would otherwise keep
+# running while the EXIT trap removes their scratch directories
+trap 'stop_jobs; exit 130' INT
+trap 'stop_jobs; exit 143' TERM
+
+# Wait until at least one running job has finished and record its status.
+# Each job writes its status to a file just before it exits, so a job
+# that ends between the check and the wait is not missed. A job that is
+# gone without one died abnormally and counts as failed.
+reap() {
+    local i still status_file
+    while :; do
+        still=()
+        for i in "${running[@]}"; do
+            status_file="$WORK_DIR/${job_names[$i]}/status"
+            if [ -f "$status_file" ] || ! kill -0 "${job_pids[$i]}" 2> /dev/null; then
+                wait "${job_pids[$i]}" 2> /dev/null
+                job_status[$i]=$(cat "$status_file" 2> /dev/null || echo 1)
+                if [ "${job_status[$i]}" = 1 ] && [ $FAIL_FAST -eq 1 ]; then
+                    ABORTED=1
+                fi
+            else
+                still+=("$i")
+            fi
+        done
+        if [ ${#still[@]} -lt ${#running[@]} ]; then
+            running=("${still[@]}")
+            return
+        fi
+        if [ $HAVE_WAIT_N -eq 1 ]; then
+            wait -n 2> /dev/null
+        else
+            sleep 0.05
+        fi
+    done
+}
+
+# Print the reports of the finished jobs at the head of the queue and
+# update the counters. With --all, report every finished job and skip
+# the unfinished ones (after the rest were stopped).
+report() {
+    local status
+    while [ $next_report -lt ${#job_names[@]} ]; do
+        status=${job_status[$next_report]}
+        if [ -n "$status" ]; then
+            cat "$WORK_DIR/${job_names[$next_report]}/log"
+            TOTAL=$((TOTAL + 1))
+            if [ $status -eq 0 ]; then
+                PASSED=$((PASSED + 1))
+            elif [ $status -eq 1 ]; then
+                FAILED=$((FAILED + 1))
+            fi
+        elif [ "$1" != --all ]; then
+            return
+        fi
+        next_report=$((next_report + 1))
+    done
+}
+
+# Start the slowest tests first (by last run's times) so a long test
+# doesn't end up running alone at the end; tests with no recorded time
+# might be the slowest of all, so they go first
+if [ -f "$TIMES_FILE" ] && [ ${#tests[@]} -gt 1 ]; then
+    ordered=()
+    while read -r _ _ test_name; do
+        ordered+=("$test_name")
+    done < <(printf '%s\n' "${tests[@]}" \
+        | awk 'NR == FNR { t[$1] = $2; next } { print (($1 in t) ? "0 " t[$1] : "1 0"), $1 }' "$TIMES_FILE" - \
+        | sort -k1,1nr -k2,2nr -k3,3)
+    tests=("${ordered[@]}")
+fi
+
+# Run the tests, at most $JOBS at a time
+for test_name in "${tests[@]}"; do
+    if [ ${#running[@]} -ge $JOBS ]; then
+        reap
+        report
+    fi
+    if [ $ABORTED -eq 1 ]; then
+        break
+    fi
+    mkdir "$WORK_DIR/$test_name"
+    { timed_test "$test_name"; echo $? > "$WORK_DIR/$test_name/status"; } > "$WORK_DIR/$test_name/log" 2>&1 &
+    running+=(${#job_names[@]})
+    job_names+=("$test_name")
+    job_pids+=($!)
+done
+while [ ${#running[@]} -gt 0 ] && [ $ABORTED -eq 0 ]; do
+    reap
+    report
 done
+if [ $ABORTED -eq 1 ]; then
+    # Don't wait on tests whose results won't be reported
+    stop_jobs
+fi
+report --all
+
+# Remember this run's times, keeping those of tests that didn't run and
+# dropping those of tests that no longer exist
+if [ -f "$WORK_DIR/times" ] || [ -f "$TIMES_FILE" ]; then
+    touch "$WORK_DIR/times"
+    cat "$TIMES_FILE" 2> /dev/null \
+        | awk 'NR == FNR { t[$1] = $2; next } !($1 in t) { print } END { for (n in t) print n, t[n] }' "$WORK_DIR/times" - \
+        | while read -r test_name ms; do
+            if [ -f "tests/asm/${test_name}.asm" ]; then
+                echo "$test_name $ms"
+            fi
+        done \
+        | sort > "$WORK_DIR/times.new" && mv "$WORK_DIR/times.new" "$TIMES_FILE"
+fi
 
 # Summary
 echo
@@ -109,6 +533,9 @@ echo "Test Results:"
 echo -e "  Passed: ${GREEN}$PASSED${NC}"
 echo -e "  Failed: ${RED}$FAILED${NC}"
 echo -e "  Total:  $TOTAL"
+if [ $ABORTED -eq 1 ]; then
+    echo -e "  ${YELLOW}Stopped after the first failure (--fail-fast)${NC}"
+fi
 
 if [ $FAILED -eq 0 ]; then
     echo -e "\n${GREEN}All tests passed!${NC}"